@@ -1,14 +1,33 @@
 import os
+import asyncio
+import atexit
+import functools
+import hashlib
+import json
+import textwrap
+import threading
+import queue
+from collections import OrderedDict
+from dataclasses import dataclass
 from dotenv import load_dotenv
-from langchain_google_genai import ChatGoogleGenerativeAI
+from langchain_google_genai import ChatGoogleGenerativeAI, GoogleGenerativeAIEmbeddings
 from langchain_core.prompts import PromptTemplate
-from typing import Dict, Optional
+from typing import AsyncIterator, Awaitable, Callable, Dict, List, Literal, Optional, Tuple
 import logging
-import traceback
+import faiss
+import numpy as np
+import orjson
 from google.api_core.exceptions import ResourceExhausted, Forbidden
 
 # Set up logging
-logging.basicConfig(level=logging.DEBUG, format='%(asctime)s - %(levelname)s - %(message)s')
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+if not isinstance(logging.getLevelName(LOG_LEVEL), int):
+    # Unknown level names would make basicConfig raise at import
+    LOG_LEVEL = "INFO"
+logging.basicConfig(level=LOG_LEVEL, format='%(asctime)s - %(levelname)s - %(message)s')
+# Keep per-request HTTP chatter out of the log unless explicitly asked for
+logging.getLogger("httpx").setLevel(logging.WARNING)
+logging.getLogger("google").setLevel(logging.WARNING)
 logger = logging.getLogger(__name__)
 
 # Load environment variables
@@ -17,244 +36,644 @@ API_KEY = os.getenv("GOOGLE_API_KEY")
 if not API_KEY:
     logger.error("GOOGLE_API_KEY not found in .env file")
     raise ValueError("GOOGLE_API_KEY is required")
-logger.info(f"API Key loaded: {API_KEY[:4]}...{API_KEY[-4:]}")
+logger.info("API Key loaded: %s...%s", API_KEY[:4], API_KEY[-4:])
 
-class Agent:
-    def __init__(self, role: str, input_data: Optional[Dict] = None):
+# Model settings shared by every agent
+MODEL_NAME = "gemini-1.5-flash"
+TEMPERATURE = 0.1
+MAX_TOKENS = 512
+TOP_P = 0.9
+# Rate-limit retries with exponential backoff happen inside the client, so they
+# cover invoke, stream and batch calls alike; nothing else should retry on top
+MAX_RETRIES = 5
+
+@functools.lru_cache(maxsize=8)
+def _get_model(model_name: str, temperature: float, max_tokens: int, top_p: float) -> ChatGoogleGenerativeAI:
+    """Build one Gemini client per configuration and reuse it across agents."""
+    return ChatGoogleGenerativeAI(
+        model=model_name,
+        google_api_key=API_KEY,
+        temperature=temperature,
+        max_tokens=max_tokens,
+        top_p=top_p,
+        max_retries=MAX_RETRIES
+    )
+
+# Semantic response cache settings
+EMBEDDING_MODEL = "models/embedding-001"
+# Set to persist the semantic cache (which contains patient text) across runs
+SEMANTIC_CACHE_DIR = os.getenv("SEMANTIC_CACHE_DIR")
+# The cache costs an embedding call per lookup, which only pays off when entries outlive a
+# single CLI query: it is on when persisted, with SEMANTIC_CACHE=1, or when a long-lived
+# caller sets this flag
+SEMANTIC_CACHE_ENABLED = bool(SEMANTIC_CACHE_DIR) or os.getenv("SEMANTIC_CACHE", "").lower() in ("1", "true", "yes")
+SEMANTIC_CACHE_THRESHOLD = 0.92
+# Entries kept at full precision before the index is trained and switched to int8
+SEMANTIC_CACHE_TRAIN_SIZE = 1000
+# Quantized hits scoring within this margin of the threshold are re-checked at full precision;
+# 8-bit quantization moves cosine scores by far less than this
+SEMANTIC_CACHE_VERIFY_MARGIN = 0.02
+
+@functools.lru_cache(maxsize=1)
+def _get_embeddings() -> GoogleGenerativeAIEmbeddings:
+    """Build the embedding client once and reuse it for every cache lookup."""
+    return GoogleGenerativeAIEmbeddings(model=EMBEDDING_MODEL, google_api_key=API_KEY)
+
+class SemanticCache:
+    """Per-role nearest-neighbour cache of model responses, optionally persisted to disk.
+
+    The first SEMANTIC_CACHE_TRAIN_SIZE entries live in an exact float32 index;
+    after that the index is retrained as an 8-bit scalar quantizer, which keeps
+    a quarter of the index memory. The query and response text of each entry
+    stay in memory regardless. Quantized hits close to the threshold are
+    re-checked against the stored query text before being served.
+    """
+
+    def __init__(self, role: str, cache_dir: Optional[str] = SEMANTIC_CACHE_DIR):
         self.role = role
-        self.input_data = input_data or {}
-        self.prompt_template = self.create_prompt_template()
-        # Initialize Gemini model via LangChain
-        try:
-            self.model = ChatGoogleGenerativeAI(
-                model="gemini-1.5-flash",
-                google_api_key=API_KEY,
-                temperature=0.1,
-                max_tokens=512,
-                top_p=0.9
-            )
-            logger.info(f"{self.role} model initialized successfully")
-        except Exception as e:
-            logger.error(f"Failed to initialize {self.role} model: {str(e)}\n{traceback.format_exc()}")
-            self.model = None
-
-    def create_prompt_template(self) -> PromptTemplate:
-        # Simplified prompts to avoid safety filters
-        templates = {
-            "GeneralDoctor": PromptTemplate.from_template("""
-                You are a medical assistant analyzing patient-reported symptoms. Provide 2-3 possible conditions with brief reasons, using this exact format:
-                - Condition 1: [Name] - [Reason]
-                - Condition 2: [Name] - [Reason]
-                - Condition 3: [Name] - [Reason]
-                Input: {symptoms}
-            """),
-            "Diagnosis": PromptTemplate.from_template("""
-                You are a medical assistant reviewing a preliminary assessment. Suggest a likely condition, clinic type, and specialist type, using this exact format:
-                - Diagnosis: [Condition] - [Explanation]
-                - Recommended Clinic: [Clinic type]
-                - Recommended Doctor Type: [Specialist type]
-                Input: {preliminary_assessment}
-            """),
-            "Medication": PromptTemplate.from_template("""
-                You are a medical assistant providing treatment options based on a diagnosis. Suggest 2-3 medications with their role, dosage, and schedule, using this exact format:
-                - Medication 1: [Name] - Role: [Role] - Dosage: [Dosage] - Schedule: [Schedule]
-                - Medication 2: [Name] - Role: [Role] - Dosage: [Dosage] - Schedule: [Schedule]
-                - Medication 3: [Name] - Role: [Role] - Dosage: [Dosage] - Schedule: [Schedule]
-                Input: {diagnosis}
-            """),
-            "FollowUp": PromptTemplate.from_template("""
-                You are a medical assistant coordinating follow-up care. Suggest 2 follow-up actions and monitoring tips, using this exact format:
-                - Follow-Up Action 1: [Action] - [Timeline]
-                - Follow-Up Action 2: [Action] - [Timeline]
-                - Monitoring for New Issues: [Suggestions]
-                Input:
-                - Symptoms: {symptoms}
-                - Preliminary Assessment: {preliminary_assessment}
-                - Diagnosis: {diagnosis}
-                - Medications: {medications}
-            """)
-        }
-        return templates[self.role]
-
-    def run(self) -> Optional[str]:
-        if not self.model:
-            logger.error(f"{self.role} Agent model not initialized")
+        self.cache_dir = cache_dir
+        self.index = None
+        self.entries: List[Dict[str, str]] = []
+        self.dirty = False
+        if not cache_dir:
+            return
+        self.index_path = os.path.join(cache_dir, f"{role}.inputs.index")
+        self.entries_path = os.path.join(cache_dir, f"{role}.inputs.json")
+        if os.path.exists(self.index_path) and os.path.exists(self.entries_path):
+            try:
+                self.index = faiss.read_index(self.index_path)
+                with open(self.entries_path, "r", encoding="utf-8") as f:
+                    self.entries = json.load(f)
+            except Exception as e:
+                logger.warning("%s semantic cache could not be loaded: %s", self.role, e)
+                self.index, self.entries = None, []
+
+    @property
+    def quantized(self) -> bool:
+        return isinstance(self.index, faiss.IndexScalarQuantizer)
+
+    @staticmethod
+    def _normalize(embedding: List[float]) -> np.ndarray:
+        vector = np.asarray([embedding], dtype="float32")
+        faiss.normalize_L2(vector)
+        return vector
+
+    def lookup(self, embedding: List[float]) -> Optional[Tuple[Dict[str, str], float]]:
+        """Return the closest stored entry and its score if it clears the similarity threshold."""
+        if self.index is None or self.index.ntotal == 0:
             return None
-        logger.info(f"{self.role} Agent is processing")
-        try:
-            # Format prompt based on role
-            if self.role == "GeneralDoctor":
-                if not self.input_data.get("symptoms"):
-                    logger.error(f"{self.role} Agent: Missing symptoms")
-                    return None
-                prompt = self.prompt_template.format(symptoms=self.input_data["symptoms"])
-            elif self.role == "Diagnosis":
-                if not self.input_data.get("preliminary_assessment"):
-                    logger.error(f"{self.role} Agent: Missing preliminary assessment")
-                    return None
-                prompt = self.prompt_template.format(preliminary_assessment=self.input_data["preliminary_assessment"])
-            elif self.role == "Medication":
-                if not self.input_data.get("diagnosis"):
-                    logger.error(f"{self.role} Agent: Missing diagnosis")
-                    return None
-                prompt = self.prompt_template.format(diagnosis=self.input_data["diagnosis"])
-            elif self.role == "FollowUp":
-                required_keys = ["symptoms", "preliminary_assessment", "diagnosis", "medications"]
-                if not all(self.input_data.get(key) for key in required_keys):
-                    logger.error(f"{self.role} Agent: Missing required inputs")
-                    return None
-                prompt = self.prompt_template.format(**self.input_data)
-
-            # Debug: Log the prompt
-            # logger.debug(f"{self.role} Prompt:\n{prompt}")
-            # Invoke model
-            response = self.model.invoke(prompt)
-            # Extract text from response
-            response_text = response.content if hasattr(response, "content") else str(response)
-            # Debug: Log raw response
-            # logger.debug(f"{self.role} Raw Response:\n{response_text}")
-            # Check for safety block
-            if not response_text.strip():
-                logger.warning(f"{self.role} Agent: Empty response, possibly blocked by safety filters")
-                return "Blocked: Response filtered due to content restrictions"
-            return response_text
-        except ResourceExhausted:
-            logger.error(f"{self.role} Agent: Rate limit exceeded\n{traceback.format_exc()}")
-            return "Error: Rate limit exceeded, please try again later"
-        except Forbidden:
-            logger.error(f"{self.role} Agent: API key permission error\n{traceback.format_exc()}")
-            return "Error: Invalid API key or insufficient permissions"
-        except Exception as e:
-            logger.error(f"Error in {self.role} Agent: {str(e)}\n{traceback.format_exc()}")
+        scores, ids = self.index.search(self._normalize(embedding), 1)
+        if ids[0][0] < 0 or scores[0][0] < SEMANTIC_CACHE_THRESHOLD:
             return None
+        logger.info("%s semantic cache hit (score %.3f)", self.role, scores[0][0])
+        return self.entries[ids[0][0]], float(scores[0][0])
 
-class GeneralDoctorAgent(Agent):
-    def __init__(self, symptoms: str):
-        super().__init__(role="GeneralDoctor", input_data={"symptoms": symptoms})
-
-class DiagnosisAgent(Agent):
-    def __init__(self, preliminary_assessment: str):
-        super().__init__(role="Diagnosis", input_data={"preliminary_assessment": preliminary_assessment})
-
-class MedicationAgent(Agent):
-    def __init__(self, diagnosis: str):
-        super().__init__(role="Medication", input_data={"diagnosis": diagnosis})
-
-class FollowUpAgent(Agent):
-    def __init__(self, symptoms: str, preliminary_assessment: str, diagnosis: str, medications: str):
-        super().__init__(role="FollowUp", input_data={
-            "symptoms": symptoms,
-            "preliminary_assessment": preliminary_assessment,
-            "diagnosis": diagnosis,
-            "medications": medications
+    async def verify(self, embedding: List[float], query: str, entry: Dict[str, str], score: float) -> bool:
+        """Confirm a borderline quantized hit at full precision by re-embedding the stored query."""
+        if not self.quantized or score >= SEMANTIC_CACHE_THRESHOLD + SEMANTIC_CACHE_VERIFY_MARGIN:
+            return True
+        if entry["query_hash"] == hashlib.sha256(query.encode("utf-8")).hexdigest():
+            return True
+        if not entry.get("query"):
+            return False
+        stored = self._normalize(await _get_embeddings().aembed_query(entry["query"]))
+        score = float(np.dot(self._normalize(embedding)[0], stored[0]))
+        if score < SEMANTIC_CACHE_THRESHOLD:
+            logger.info("%s semantic cache hit rejected at full precision (score %.3f)", self.role, score)
+            return False
+        return True
+
+    def _quantize(self) -> None:
+        """Retrain the exact index as an 8-bit scalar quantizer over the same vectors."""
+        vectors = self.index.reconstruct_n(0, self.index.ntotal)
+        index = faiss.IndexScalarQuantizer(vectors.shape[1], faiss.ScalarQuantizer.QT_8bit, faiss.METRIC_INNER_PRODUCT)
+        index.train(vectors)
+        index.add(vectors)
+        self.index = index
+        logger.info("%s semantic cache quantized to int8 (%d entries)", self.role, index.ntotal)
+
+    def insert(self, embedding: List[float], query: str, response_text: str) -> None:
+        vector = self._normalize(embedding)
+        if self.index is None:
+            self.index = faiss.IndexFlatIP(vector.shape[1])
+        self.index.add(vector)
+        self.entries.append({
+            "query_hash": hashlib.sha256(query.encode("utf-8")).hexdigest(),
+            "query": query,
+            "response": response_text
         })
+        if not self.quantized and self.index.ntotal >= SEMANTIC_CACHE_TRAIN_SIZE:
+            self._quantize()
+        self.dirty = True
+
+    def save(self) -> None:
+        """Write the index and sidecar if persistence is enabled and anything changed."""
+        if not self.cache_dir or not self.dirty or self.index is None:
+            return
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            faiss.write_index(self.index, self.index_path)
+            with open(self.entries_path, "w", encoding="utf-8") as f:
+                json.dump(self.entries, f)
+            self.dirty = False
+        except OSError as e:
+            logger.warning("%s semantic cache could not be saved: %s", self.role, e)
+
+_SEMANTIC_CACHES: Dict[str, SemanticCache] = {}
+
+def _save_semantic_caches() -> None:
+    for cache in _SEMANTIC_CACHES.values():
+        cache.save()
+
+# Saving rewrites the whole index, so do it once at exit rather than on every miss
+atexit.register(_save_semantic_caches)
+
+def _semantic_query(role: str, input_data: Dict[str, str]) -> str:
+    """Text embedded for the semantic cache: only the role's inputs, not the fixed instructions.
+
+    Embedding the whole prompt lets the shared instruction text dominate, so
+    unrelated complaints can look near-identical.
+    """
+    return "\n".join(f"{key}: {input_data[key]}" for key in _ROLE_REQUIRED[role])
+
+def _semantic_cached(invoke: Callable[..., Awaitable[str]]) -> Callable[..., Awaitable[str]]:
+    """Serve semantically equivalent inputs for the same role from the cache."""
+    @functools.wraps(invoke)
+    async def wrapper(role: str, prompt: str, input_data: Dict[str, str]) -> str:
+        if not SEMANTIC_CACHE_ENABLED:
+            return await invoke(role, prompt, input_data)
+        cache = _SEMANTIC_CACHES.get(role)
+        if cache is None:
+            cache = _SEMANTIC_CACHES[role] = SemanticCache(role)
+        query = _semantic_query(role, input_data)
+        try:
+            embedding = await _get_embeddings().aembed_query(query)
+            hit = cache.lookup(embedding)
+            if hit is not None and await cache.verify(embedding, query, *hit):
+                return hit[0]["response"]
+        except Exception as e:
+            logger.warning("%s embedding failed, bypassing semantic cache: %s", role, e)
+            return await invoke(role, prompt, input_data)
+        response_text = await invoke(role, prompt, input_data)
+        if response_text.strip():
+            cache.insert(embedding, query, response_text)
+        return response_text
+    return wrapper
+
+# Exact-match response cache; only safe while sampling is near-deterministic
+EXACT_CACHE_SIZE = 1024
+_EXACT_CACHE: "OrderedDict[Tuple[str, str], str]" = OrderedDict()
+
+def _exact_cache_key(role: str, prompt: str) -> Optional[Tuple[str, str]]:
+    if TEMPERATURE > 0.1:
+        return None
+    return (role, hashlib.sha256(prompt.encode("utf-8")).hexdigest())
+
+def _exact_cache_get(key: Optional[Tuple[str, str]]) -> Optional[str]:
+    if key is None or key not in _EXACT_CACHE:
+        return None
+    _EXACT_CACHE.move_to_end(key)
+    logger.info("%s exact cache hit", key[0])
+    return _EXACT_CACHE[key]
+
+def _exact_cache_put(key: Optional[Tuple[str, str]], response_text: str) -> None:
+    if key is None or not response_text.strip():
+        return
+    _EXACT_CACHE[key] = response_text
+    if len(_EXACT_CACHE) > EXACT_CACHE_SIZE:
+        _EXACT_CACHE.popitem(last=False)
+
+def _exact_cached(invoke: Callable[..., Awaitable[str]]) -> Callable[..., Awaitable[str]]:
+    """Serve byte-identical prompts for the same role from an in-memory LRU."""
+    @functools.wraps(invoke)
+    async def wrapper(role: str, prompt: str, input_data: Dict[str, str]) -> str:
+        key = _exact_cache_key(role, prompt)
+        cached = _exact_cache_get(key)
+        if cached is not None:
+            return cached
+        response_text = await invoke(role, prompt, input_data)
+        _exact_cache_put(key, response_text)
+        return response_text
+    return wrapper
+
+def _template(text: str) -> PromptTemplate:
+    """Dedent and trim a prompt so its static prefix is byte-identical on every call."""
+    return PromptTemplate.from_template(textwrap.dedent(text).strip())
+
+# Prompt templates are parsed once at import and shared by every agent
+# (simplified prompts to avoid safety filters). Static instructions come first
+# and the dynamic input last, so provider-side prompt caching can reuse the prefix.
+_PROMPT_TEMPLATES: Dict[str, PromptTemplate] = {
+    "GeneralDoctor": _template("""
+        You are a medical assistant analyzing patient-reported symptoms. Provide 2-3 possible conditions with brief reasons, using this exact format:
+        - Condition 1: [Name] - [Reason]
+        - Condition 2: [Name] - [Reason]
+        - Condition 3: [Name] - [Reason]
+        Input: {symptoms}
+    """),
+    "Diagnosis": _template("""
+        You are a medical assistant reviewing a preliminary assessment. Suggest a likely condition, clinic type, and specialist type, using this exact format:
+        - Diagnosis: [Condition] - [Explanation]
+        - Recommended Clinic: [Clinic type]
+        - Recommended Doctor Type: [Specialist type]
+        Input: {preliminary_assessment}
+    """),
+    "Medication": _template("""
+        You are a medical assistant providing treatment options based on a diagnosis. Suggest 2-3 medications with their role, dosage, and schedule, using this exact format:
+        - Medication 1: [Name] - Role: [Role] - Dosage: [Dosage] - Schedule: [Schedule]
+        - Medication 2: [Name] - Role: [Role] - Dosage: [Dosage] - Schedule: [Schedule]
+        - Medication 3: [Name] - Role: [Role] - Dosage: [Dosage] - Schedule: [Schedule]
+        Input: {diagnosis}
+    """),
+    "FollowUp": _template("""
+        You are a medical assistant coordinating follow-up care. Suggest 2 follow-up actions and monitoring tips, using this exact format:
+        - Follow-Up Action 1: [Action] - [Timeline]
+        - Follow-Up Action 2: [Action] - [Timeline]
+        - Monitoring for New Issues: [Suggestions]
+        Input:
+        - Symptoms: {symptoms}
+        - Preliminary Assessment: {preliminary_assessment}
+        - Diagnosis: {diagnosis}
+        - Medications: {medications}
+    """)
+}
+
+# Inputs each role's prompt needs; all must be non-empty and contain letters
+_ROLE_REQUIRED: Dict[str, List[str]] = {
+    "GeneralDoctor": ["symptoms"],
+    "Diagnosis": ["preliminary_assessment"],
+    "Medication": ["diagnosis"],
+    "FollowUp": ["symptoms", "preliminary_assessment", "diagnosis", "medications"]
+}
+
+@dataclass(frozen=True)
+class AgentResult:
+    """Outcome of a single agent run; text is empty when there is nothing to show."""
+    status: Literal["ok", "rate_limit", "forbidden", "blocked", "error"]
+    text: str
+
+# Shortest free-text symptom description worth a model call
+MIN_SYMPTOMS_LENGTH = 5
+
+def _input_problem(key: str, text: str) -> Optional[str]:
+    """Why an input is not worth a model call, or None if it is usable."""
+    field = key.replace("_", " ")
+    if not any(c.isalpha() for c in text):
+        return f"Error: Please describe the {field} in words; the input contains no letters"
+    # Only free-text symptoms need a minimum length; "flu" or "none" are valid elsewhere
+    if key == "symptoms" and len(text.strip()) < MIN_SYMPTOMS_LENGTH:
+        return f"Error: Please provide at least {MIN_SYMPTOMS_LENGTH} characters of symptom description"
+    return None
+
+def _check_inputs(role: str, input_data: Dict[str, str]) -> Optional[AgentResult]:
+    """Reject missing or degenerate inputs before any model call; None if they are usable."""
+    required = _ROLE_REQUIRED[role]
+    missing = [key for key in required if not input_data.get(key)]
+    if missing:
+        logger.error("%s Agent: Missing %s", role, ", ".join(missing))
+        return AgentResult("error", "")
+    for key in required:
+        problem = _input_problem(key, input_data[key])
+        if problem:
+            logger.warning("%s Agent: Rejected %s input: %s", role, key, problem)
+            return AgentResult("error", problem)
+    return None
+
+def _build_prompt(role: str, input_data: Dict[str, str]) -> str:
+    return _PROMPT_TEMPLATES[role].format(**{key: input_data[key] for key in _ROLE_REQUIRED[role]})
+
+def _response_text(response) -> str:
+    # Extract text from response
+    return response.content if hasattr(response, "content") else str(response)
+
+def _to_result(role: str, response_text: str) -> AgentResult:
+    # Check for safety block
+    if not response_text.strip():
+        logger.warning("%s Agent: Empty response, possibly blocked by safety filters", role)
+        return AgentResult("blocked", "Blocked: Response filtered due to content restrictions")
+    return AgentResult("ok", response_text)
+
+def _error_result(role: str, e: Exception) -> AgentResult:
+    # exc_info defers traceback formatting to the logging framework
+    if isinstance(e, ResourceExhausted):
+        logger.error("%s Agent: Rate limit exceeded", role, exc_info=e)
+        return AgentResult("rate_limit", "Error: Rate limit exceeded, please try again later")
+    if isinstance(e, Forbidden):
+        logger.error("%s Agent: API key permission error", role, exc_info=e)
+        return AgentResult("forbidden", "Error: Invalid API key or insufficient permissions")
+    logger.error("Error in %s Agent: %s", role, e, exc_info=e)
+    return AgentResult("error", "")
+
+async def run_agent(role: str, on_chunk: Optional[Callable[[str], None]] = None, **input_data: str) -> AgentResult:
+    """Run one agent role on the given inputs; if on_chunk is given, the response is streamed to it."""
+    try:
+        model = _get_model(MODEL_NAME, TEMPERATURE, MAX_TOKENS, TOP_P)
+    except Exception as e:
+        logger.exception("Failed to initialize %s model: %s", role, e)
+        return AgentResult("error", "")
+    logger.info("%s Agent is processing", role)
+    try:
+        failure = _check_inputs(role, input_data)
+        if failure:
+            return failure
+        prompt = _build_prompt(role, input_data)
+
+        # Debug: Log the prompt
+        # logger.debug("%s Prompt:\n%s", role, prompt)
+        # Invoke model (or reuse a cached answer to an equivalent prompt)
+        if on_chunk is None:
+            response_text = await _invoke(role, prompt, input_data)
+        else:
+            chunks = []
+            async for chunk in _stream(model, role, prompt):
+                chunks.append(chunk)
+                on_chunk(chunk)
+            response_text = "".join(chunks)
+        # Debug: Log raw response
+        # logger.debug("%s Raw Response:\n%s", role, response_text)
+        return _to_result(role, response_text)
+    except Exception as e:
+        return _error_result(role, e)
 
-def run_workflow(symptoms: str) -> Dict[str, str]:
+@_exact_cached
+@_semantic_cached
+async def _invoke(role: str, prompt: str, input_data: Dict[str, str]) -> str:
+    response = await _get_model(MODEL_NAME, TEMPERATURE, MAX_TOKENS, TOP_P).ainvoke(prompt)
+    return _response_text(response)
+
+async def _stream(model: ChatGoogleGenerativeAI, role: str, prompt: str) -> AsyncIterator[str]:
+    """Yield response text as the model generates it, reusing exact-cache hits."""
+    key = _exact_cache_key(role, prompt)
+    cached = _exact_cache_get(key)
+    if cached is not None:
+        yield cached
+        return
+    chunks = []
+    async for chunk in model.astream(prompt):
+        text = _response_text(chunk)
+        chunks.append(text)
+        yield text
+    _exact_cache_put(key, "".join(chunks))
+
+# Workflow stages in order: (result key, role, inputs built from the symptoms and earlier results)
+_WORKFLOW_STAGES: List[Tuple[str, str, Callable[[str, Dict[str, str]], Dict[str, str]]]] = [
+    ("general_doctor", "GeneralDoctor", lambda symptoms, results: {"symptoms": symptoms}),
+    ("diagnosis", "Diagnosis", lambda symptoms, results: {"preliminary_assessment": results["general_doctor"]}),
+    ("medication", "Medication", lambda symptoms, results: {"diagnosis": results["diagnosis"]}),
+    ("follow_up", "FollowUp", lambda symptoms, results: {
+        "symptoms": symptoms,
+        "preliminary_assessment": results["general_doctor"],
+        "diagnosis": results["diagnosis"],
+        "medications": results["medication"]
+    })
+]
+
+# Optional JSONL audit trail of workflow results, written off the request path
+WORKFLOW_LOG_PATH = os.getenv("LOG_WORKFLOWS")
+_workflow_records: "queue.Queue[bytes]" = queue.Queue()
+_workflow_writer: Optional[threading.Thread] = None
+
+def _write_workflow_records() -> None:
+    while True:
+        record = _workflow_records.get()
+        try:
+            with open(WORKFLOW_LOG_PATH, "ab") as f:
+                f.write(record)
+        except OSError as e:
+            logger.warning("Could not write workflow record to %s: %s", WORKFLOW_LOG_PATH, e)
+        finally:
+            _workflow_records.task_done()
+
+def _record_workflow(symptoms: str, results: Dict[str, str]) -> None:
+    """Queue a workflow's results for the JSONL sink when LOG_WORKFLOWS is set."""
+    global _workflow_writer
+    if not WORKFLOW_LOG_PATH:
+        return
+    if _workflow_writer is None:
+        _workflow_writer = threading.Thread(target=_write_workflow_records, daemon=True)
+        _workflow_writer.start()
+        # Flush pending records before the interpreter exits
+        atexit.register(_workflow_records.join)
+    _workflow_records.put(orjson.dumps({"symptoms": symptoms, **results}) + b"\n")
+
+async def run_workflow(symptoms: str, on_output: Optional[Callable[[str, str], None]] = None) -> Dict[str, str]:
+    """Run all agents in order.
+
+    If on_output is given it receives (result key, text) for each completed
+    intermediate step and the final follow-up text chunk by chunk as it streams.
+    """
     results = {}
-    logger.info("Starting workflow")
-    
-    # Step 1: General Doctor
-    general_doctor = GeneralDoctorAgent(symptoms)
-    results["general_doctor"] = general_doctor.run()
-    if not results["general_doctor"] or "Error" in results["general_doctor"] or "Blocked" in results["general_doctor"]:
-        logger.warning("General Doctor Agent failed. Stopping workflow.")
-        return results
-    
-    # Step 2: Diagnosis
-    diagnosis_agent = DiagnosisAgent(results["general_doctor"])
-    results["diagnosis"] = diagnosis_agent.run()
-    if not results["diagnosis"] or "Error" in results["diagnosis"] or "Blocked" in results["diagnosis"]:
-        logger.warning("Diagnosis Agent failed. Stopping workflow.")
-        return results
-    
-    # Step 3: Medication
-    medication_agent = MedicationAgent(results["diagnosis"])
-    results["medication"] = medication_agent.run()
-    if not results["medication"] or "Error" in results["medication"] or "Blocked" in results["medication"]:
-        logger.warning("Medication Agent failed. Stopping workflow.")
+    try:
+        logger.info("Starting workflow")
+        final_key = _WORKFLOW_STAGES[-1][0]
+        for key, role, build_inputs in _WORKFLOW_STAGES:
+            # Only the last step is streamed; earlier outputs feed the next step whole
+            on_chunk = (lambda chunk, key=key: on_output(key, chunk)) if on_output and key == final_key else None
+            result = await run_agent(role, on_chunk=on_chunk, **build_inputs(symptoms, results))
+            results[key] = result.text
+            if on_output and on_chunk is None and result.text:
+                on_output(key, result.text)
+            if result.status != "ok":
+                logger.warning("%s Agent failed. Stopping workflow.", role)
+                return results
+
+        logger.info("Workflow completed")
         return results
-    
-    # Step 4: Follow-Up
-    follow_up_agent = FollowUpAgent(
-        symptoms=symptoms,
-        preliminary_assessment=results["general_doctor"],
-        diagnosis=results["diagnosis"],
-        medications=results["medication"]
-    )
-    results["follow_up"] = follow_up_agent.run()
-    
-    logger.info("Workflow completed")
-    return results
+    finally:
+        _record_workflow(symptoms, results)
+
+async def run_workflow_batch(symptoms_list: List[str], max_inflight: int = 8) -> List[Dict[str, str]]:
+    """Run the workflow for several patients concurrently, keeping at most max_inflight in flight."""
+    semaphore = asyncio.Semaphore(max_inflight)
+
+    async def run_one(symptoms: str) -> Dict[str, str]:
+        async with semaphore:
+            return await run_workflow(symptoms)
+
+    return await asyncio.gather(*[run_one(symptoms) for symptoms in symptoms_list])
+
+async def run_batch(symptoms_list: List[str], max_concurrency: int = 8) -> List[Dict[str, str]]:
+    """Run the workflow for many patients, sending each stage as one concurrent model batch.
+
+    A patient drops out of later stages as soon as one of its steps fails,
+    exactly as in run_workflow. Batches use the exact-match cache but not the
+    semantic cache, which needs one embedding call per prompt; use
+    run_workflow_batch when semantic hits matter more than batching.
+    """
+    all_results: List[Dict[str, str]] = [{} for _ in symptoms_list]
+    try:
+        model = _get_model(MODEL_NAME, TEMPERATURE, MAX_TOKENS, TOP_P)
+    except Exception as e:
+        # Same outcome as run_agent: every patient fails its first step
+        logger.exception("Failed to initialize batch model: %s", e)
+        first_key = _WORKFLOW_STAGES[0][0]
+        for symptoms, results in zip(symptoms_list, all_results):
+            results[first_key] = ""
+            _record_workflow(symptoms, results)
+        return all_results
+    active = list(range(len(symptoms_list)))
+    logger.info("Starting batch workflow for %d patients", len(symptoms_list))
+
+    for key, role, build_inputs in _WORKFLOW_STAGES:
+        passed = []
+        pending: List[Tuple[int, str, Optional[Tuple[str, str]]]] = []
+        for i in active:
+            input_data = build_inputs(symptoms_list[i], all_results[i])
+            failure = _check_inputs(role, input_data)
+            if failure:
+                all_results[i][key] = failure.text
+                continue
+            prompt = _build_prompt(role, input_data)
+            cache_key = _exact_cache_key(role, prompt)
+            cached = _exact_cache_get(cache_key)
+            if cached is not None:
+                all_results[i][key] = cached
+                passed.append(i)
+            else:
+                pending.append((i, prompt, cache_key))
+
+        if pending:
+            # LangChain runs batches serially unless max_concurrency is set explicitly
+            responses = await model.abatch(
+                [prompt for _, prompt, _ in pending],
+                config={"max_concurrency": max_concurrency},
+                return_exceptions=True
+            )
+            for (i, _, cache_key), response in zip(pending, responses):
+                if isinstance(response, Exception):
+                    result = _error_result(role, response)
+                else:
+                    result = _to_result(role, _response_text(response))
+                all_results[i][key] = result.text
+                if result.status == "ok":
+                    _exact_cache_put(cache_key, result.text)
+                    passed.append(i)
+                else:
+                    logger.warning("%s Agent failed for patient %d. Stopping their workflow.", role, i)
+
+        active = sorted(passed)
+        if not active:
+            break
+
+    for symptoms, results in zip(symptoms_list, all_results):
+        _record_workflow(symptoms, results)
+    logger.info("Batch workflow completed")
+    return all_results
 
 def get_user_input(prompt: str) -> str:
     """Helper function to get and clean user input."""
     return input(prompt).strip()
 
-def main():
+async def ask(prompt: str) -> str:
+    """Read input in a worker thread so the event loop keeps running meanwhile."""
+    return await asyncio.to_thread(get_user_input, prompt)
+
+def print_chunk(chunk: str) -> None:
+    """Print streamed model output as it arrives."""
+    print(chunk, end="", flush=True)
+
+async def run_agent_cli(role: str, title: str, **input_data: str) -> None:
+    """Run a single agent, streaming its answer under the given heading."""
+    print(f"\n{title}:")
+    streamed = []
+
+    def show(chunk: str) -> None:
+        streamed.append(chunk)
+        print_chunk(chunk)
+
+    result = await run_agent(role, on_chunk=show, **input_data)
+    if streamed:
+        print()
+    if result.status != "ok":
+        # A failure after partial output still gets reported on its own line
+        print(result.text or "No output available")
+
+WORKFLOW_TITLES = {
+    "general_doctor": "General Doctor Assessment",
+    "diagnosis": "Diagnosis",
+    "medication": "Medication Recommendations",
+    "follow_up": "Follow-Up Recommendations"
+}
+
+async def run_workflow_cli(symptoms: str) -> None:
+    """Run the full workflow, printing each step as soon as it is available."""
+    shown: Dict[str, List[str]] = {}
+
+    def show(key: str, chunk: str) -> None:
+        if key not in shown:
+            if shown:
+                print()
+            shown[key] = []
+            print(f"\n{WORKFLOW_TITLES[key]}:")
+        shown[key].append(chunk)
+        print_chunk(chunk)
+
+    results = await run_workflow(symptoms, on_output=show)
+    if shown:
+        print()
+    for key, title in WORKFLOW_TITLES.items():
+        if key not in shown:
+            print(f"\n{title}:")
+            print(results.get(key) or "No output available")
+        elif results.get(key) != "".join(shown[key]):
+            # The stream failed part-way; show the error after what was printed
+            print(results.get(key) or "No output available")
+
+async def prewarm_clients() -> None:
+    """Build the shared model client, including its async channel, ahead of the first request."""
+    try:
+        model = _get_model(MODEL_NAME, TEMPERATURE, MAX_TOKENS, TOP_P)
+        # The async client is only created lazily inside a running event loop, so it
+        # has to be touched from the loop that will make the calls
+        getattr(model, "async_client", None)
+        if SEMANTIC_CACHE_ENABLED:
+            _get_embeddings()
+    except Exception as e:
+        # The first real request will retry and report the failure
+        logger.debug("Client pre-warm failed: %s", e)
+
+# Prompts for each input the CLI may ask for
+INPUT_PROMPTS = {
+    "symptoms": "Enter patient symptoms: ",
+    "preliminary_assessment": "Enter preliminary assessment: ",
+    "diagnosis": "Enter diagnosis: ",
+    "medications": "Enter medications: "
+}
+
+# Single-agent menu options: choice -> (agent name, role, output heading)
+_MENU = {
+    "2": ("General Doctor", "GeneralDoctor", "General Doctor Assessment"),
+    "3": ("Diagnosis", "Diagnosis", "Diagnosis"),
+    "4": ("Medication", "Medication", "Medication Recommendations"),
+    "5": ("Follow-Up", "FollowUp", "Follow-Up Recommendations")
+}
+
+async def run_single_cli(name: str, role: str, title: str) -> None:
+    """Ask for each input the role needs, then run it."""
+    print(f"\n=== Running {name} Agent ===")
+    input_data = {key: await ask(INPUT_PROMPTS[key]) for key in _ROLE_REQUIRED[role]}
+    await run_agent_cli(role, title, **input_data)
+
+async def main():
+    # Construct clients in this loop while the user is still typing
+    prewarm = asyncio.create_task(prewarm_clients())
     print("=== Medical Workflow Interface ===")
     print("Choose an option:")
     print("1. Run full workflow")
-    print("2. Run General Doctor Agent")
-    print("3. Run Diagnosis Agent")
-    print("4. Run Medication Agent")
-    print("5. Run Follow-Up Agent")
-    
-    choice = get_user_input("Enter your choice (1-5): ")
-    
-    if choice == "1":
-        print("\n=== Running Full Workflow ===")
-        symptoms = get_user_input("Enter patient symptoms: ")
-        results = run_workflow(symptoms)
-        
-        print("\nGeneral Doctor Assessment:")
-        print(results.get("general_doctor", "No output available"))
-        
-        print("\nDiagnosis:")
-        print(results.get("diagnosis", "No output available"))
-        
-        print("\nMedication Recommendations:")
-        print(results.get("medication", "No output available"))
-        
-        print("\nFollow-Up Recommendations:")
-        print(results.get("follow_up", "No output available"))
-    
-    elif choice == "2":
-        print("\n=== Running General Doctor Agent ===")
-        symptoms = get_user_input("Enter patient symptoms: ")
-        agent = GeneralDoctorAgent(symptoms)
-        result = agent.run()
-        print("\nGeneral Doctor Assessment:")
-        print(result if result else "No output available")
-    
-    elif choice == "3":
-        print("\n=== Running Diagnosis Agent ===")
-        preliminary_assessment = get_user_input("Enter preliminary assessment: ")
-        agent = DiagnosisAgent(preliminary_assessment)
-        result = agent.run()
-        print("\nDiagnosis:")
-        print(result if result else "No output available")
-    
-    elif choice == "4":
-        print("\n=== Running Medication Agent ===")
-        diagnosis = get_user_input("Enter diagnosis: ")
-        agent = MedicationAgent(diagnosis)
-        result = agent.run()
-        print("\nMedication Recommendations:")
-        print(result if result else "No output available")
+    for option, (name, _, _) in _MENU.items():
+        print(f"{option}. Run {name} Agent")
     
-    elif choice == "5":
-        print("\n=== Running Follow-Up Agent ===")
-        symptoms = get_user_input("Enter patient symptoms: ")
-        preliminary_assessment = get_user_input("Enter preliminary assessment: ")
-        diagnosis = get_user_input("Enter diagnosis: ")
-        medications = get_user_input("Enter medications: ")
-        agent = FollowUpAgent(symptoms, preliminary_assessment, diagnosis, medications)
-        result = agent.run()
-        print("\nFollow-Up Recommendations:")
-        print(result if result else "No output available")
+    choice = await ask("Enter your choice (1-5): ")
     
-    else:
-        print("Invalid choice. Please select a number between 1 and 5.")
+    match choice:
+        case "1":
+            print("\n=== Running Full Workflow ===")
+            await run_workflow_cli(await ask(INPUT_PROMPTS["symptoms"]))
+        case option if option in _MENU:
+            await run_single_cli(*_MENU[option])
+        case _:
+            print("Invalid choice. Please select a number between 1 and 5.")
+    await prewarm
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    asyncio.run(main())
\ No newline at end of file
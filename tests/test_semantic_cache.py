@@ -0,0 +1,143 @@
+import asyncio
+import math
+import os
+import sys
+from pathlib import Path
+
+import pytest
+
+faiss = pytest.importorskip("faiss")
+np = pytest.importorskip("numpy")
+
+os.environ.setdefault("GOOGLE_API_KEY", "test-key")
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+import interactive_app as app  # noqa: E402
+
+DIM = 32
+TRAIN_SIZE = 64
+
+
+class FakeEmbeddings:
+    """Stands in for the Gemini embedding client; fails if a test did not expect a call."""
+
+    def __init__(self, vectors=None):
+        self.vectors = vectors or {}
+        self.calls = []
+
+    async def aembed_query(self, text):
+        self.calls.append(text)
+        if text not in self.vectors:
+            raise AssertionError(f"unexpected embedding call for {text!r}")
+        return self.vectors[text]
+
+
+def unit(i):
+    vector = [0.0] * DIM
+    vector[i] = 1.0
+    return vector
+
+
+def mix(a, b, cosine):
+    """Unit vector at the given cosine from unit(a), rotated towards unit(b)."""
+    vector = [0.0] * DIM
+    vector[a] = cosine
+    vector[b] = math.sqrt(1 - cosine ** 2)
+    return vector
+
+
+@pytest.fixture
+def small_train_size(monkeypatch):
+    monkeypatch.setattr(app, "SEMANTIC_CACHE_TRAIN_SIZE", TRAIN_SIZE)
+
+
+def fill(cache, count, seed=0):
+    rng = np.random.default_rng(seed)
+    vectors = rng.normal(size=(count, DIM)).tolist()
+    for i, vector in enumerate(vectors):
+        cache.insert(vector, f"query {i}", f"response {i}")
+    return vectors
+
+
+def test_index_switches_to_int8_at_train_size(small_train_size):
+    cache = app.SemanticCache("Diagnosis", cache_dir=None)
+    vectors = fill(cache, TRAIN_SIZE - 1)
+    assert isinstance(cache.index, faiss.IndexFlatIP)
+    assert not cache.quantized
+
+    cache.insert(unit(0), "last query", "last response")
+    assert cache.quantized
+    assert isinstance(cache.index, faiss.IndexScalarQuantizer)
+    assert cache.index.ntotal == TRAIN_SIZE == len(cache.entries)
+
+    # Every stored vector is still found as its own nearest neighbour, with little score drift
+    for i, vector in enumerate(vectors):
+        entry, score = cache.lookup(vector)
+        assert entry["response"] == f"response {i}"
+        assert score > 0.99
+
+
+def test_verify_skips_exact_and_clear_hits(small_train_size, monkeypatch):
+    embeddings = FakeEmbeddings()
+    monkeypatch.setattr(app, "_get_embeddings", lambda: embeddings)
+    cache = app.SemanticCache("Medication", cache_dir=None)
+    fill(cache, TRAIN_SIZE)
+    entry = cache.entries[0]
+    threshold = app.SEMANTIC_CACHE_THRESHOLD
+
+    clear = threshold + app.SEMANTIC_CACHE_VERIFY_MARGIN + 0.01
+    assert asyncio.run(cache.verify(unit(0), "another query", entry, clear))
+    borderline = threshold + 0.005
+    assert asyncio.run(cache.verify(unit(0), entry["query"], entry, borderline))
+    assert embeddings.calls == []
+
+
+def test_verify_rechecks_borderline_quantized_hits(small_train_size, monkeypatch):
+    cache = app.SemanticCache("Medication", cache_dir=None)
+    fill(cache, TRAIN_SIZE - 1)
+    cache.insert(unit(0), "stored query", "stored response")
+    entry = cache.entries[-1]
+    query = mix(0, 1, 0.93)
+    borderline = app.SEMANTIC_CACHE_THRESHOLD + 0.01
+
+    # The stored query still embeds close enough at full precision
+    embeddings = FakeEmbeddings({"stored query": unit(0)})
+    monkeypatch.setattr(app, "_get_embeddings", lambda: embeddings)
+    assert asyncio.run(cache.verify(query, "new query", entry, borderline))
+    assert embeddings.calls == ["stored query"]
+
+    # At full precision the match falls below the threshold
+    embeddings = FakeEmbeddings({"stored query": mix(0, 2, 0.5)})
+    monkeypatch.setattr(app, "_get_embeddings", lambda: embeddings)
+    assert not asyncio.run(cache.verify(query, "new query", entry, borderline))
+
+
+def test_verify_trusts_unquantized_hits(monkeypatch):
+    embeddings = FakeEmbeddings()
+    monkeypatch.setattr(app, "_get_embeddings", lambda: embeddings)
+    cache = app.SemanticCache("Diagnosis", cache_dir=None)
+    cache.insert(unit(0), "stored query", "stored response")
+    assert asyncio.run(cache.verify(unit(0), "new query", cache.entries[0], app.SEMANTIC_CACHE_THRESHOLD))
+    assert embeddings.calls == []
+
+
+def test_quantized_cache_survives_save_and_reload(small_train_size, tmp_path):
+    cache = app.SemanticCache("FollowUp", cache_dir=str(tmp_path))
+    vectors = fill(cache, TRAIN_SIZE)
+    assert cache.quantized and cache.dirty
+    cache.save()
+    assert not cache.dirty
+
+    reloaded = app.SemanticCache("FollowUp", cache_dir=str(tmp_path))
+    assert isinstance(reloaded.index, faiss.IndexScalarQuantizer)
+    assert reloaded.entries == cache.entries
+    entry, score = reloaded.lookup(vectors[5])
+    assert entry["response"] == "response 5"
+    assert score > 0.99
+
+
+def test_save_without_cache_dir_writes_nothing(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    cache = app.SemanticCache("GeneralDoctor", cache_dir=None)
+    cache.insert(unit(0), "query", "response")
+    cache.save()
+    assert list(tmp_path.iterdir()) == []